@@ -2,16 +2,131 @@
 Wtyczka QGIS do pobierania danych OpenStreetMap dla Olsztyna
 """
 
-from qgis.PyQt.QtCore import QSettings, QTranslator, QCoreApplication, Qt
+from qgis.PyQt.QtCore import QSettings, QTranslator, QCoreApplication, Qt, QUrl
+from qgis.PyQt.QtNetwork import QNetworkRequest
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtWidgets import (QAction, QDialog, QVBoxLayout, QLabel, 
                                  QPushButton, QComboBox, QMessageBox, 
                                  QProgressBar, QGroupBox, QRadioButton)
-from qgis.core import (QgsProject, QgsRasterLayer, QgsVectorLayer, 
-                       QgsCoordinateReferenceSystem, QgsRectangle)
+from qgis.core import (Qgis, QgsProject, QgsRasterLayer, QgsVectorLayer, 
+                       QgsCoordinateReferenceSystem, QgsRectangle,
+                       QgsNetworkAccessManager)
+import math
 import os.path
 
 
+# Nagłówek Referer wysyłany do serwerów kafelków (wymagany m.in. przez
+# zasady korzystania z tile.openstreetmap.org)
+_REFERER = "https://github.com/jakubdeoniziak/olsztyn_geoportal"
+
+# Połowa obwodu Ziemi w Web Mercator (EPSG:3857), w metrach
+_MERCATOR_HALF_SIZE = math.pi * 6378137.0
+
+# Górny limit liczby kafelków pobieranych z wyprzedzeniem
+_MAX_PREFETCH_TILES = 64
+
+# Minimalny rozmiar dyskowego cache sieciowego QGIS (kafelki Olsztyna)
+_MIN_CACHE_SIZE = 512 * 1024 * 1024
+
+# Klucze ustawienia rozmiaru cache (nowsze wersje QGIS: "cache/size-bytes")
+_CACHE_SIZE_KEYS = ("cache/size-bytes", "cache/size")
+
+# Definicje warstw OpenStreetMap
+_LAYERS = {
+    "Standardowa mapa OSM": {
+        "type": "xyz",
+        "url": "https://tile.openstreetmap.org/{z}/{x}/{y}.png",
+        "zmin": 0,
+        "zmax": 19,
+        "crs": "EPSG:3857",
+        "info": "Standardowa mapa OpenStreetMap z pełnymi detalami"
+    },
+    "OpenTopoMap (topograficzna)": {
+        "type": "xyz",
+        "url": "https://a.tile.opentopomap.org/{z}/{x}/{y}.png",
+        "zmin": 0,
+        "zmax": 17,
+        "crs": "EPSG:3857",
+        "info": "Mapa topograficzna ze szlakiami i warstwicami"
+    },
+    "CyclOSM (dla rowerzystów)": {
+        "type": "xyz",
+        "url": "https://a.tile-cyclosm.openstreetmap.fr/cyclosm/{z}/{x}/{y}.png",
+        "zmin": 0,
+        "zmax": 20,
+        "crs": "EPSG:3857",
+        "info": "Mapa z wyróżnionymi ścieżkami rowerowymi"
+    },
+    "Humanitarian (humanitarna)": {
+        "type": "xyz",
+        "url": "https://a.tile.openstreetmap.fr/hot/{z}/{x}/{y}.png",
+        "zmin": 0,
+        "zmax": 20,
+        "crs": "EPSG:3857",
+        "info": "Mapa humanitarna z wyróżnionymi budynkami"
+    },
+    "Transport": {
+        "type": "xyz",
+        "url": "https://tile.memomaps.de/tilegen/{z}/{x}/{y}.png",
+        "zmin": 0,
+        "zmax": 18,
+        "crs": "EPSG:3857",
+        "info": "Mapa komunikacji publicznej i transportu"
+    }
+}
+
+# Hosty serwerów kafelków używanych przez wtyczkę
+_TILE_HOSTS = {QUrl(info["url"]).host() for info in _LAYERS.values()}
+
+# Atrybut żądania zezwalający na HTTP/2 (przed Qt 5.15: HTTP2AllowedAttribute)
+_HTTP2_ATTRIBUTE = getattr(QNetworkRequest, "Http2AllowedAttribute",
+                           getattr(QNetworkRequest, "HTTP2AllowedAttribute", None))
+
+# Style widżetów dialogu
+_INFO_LABEL_QSS = "font-weight: bold; margin-bottom: 10px;"
+_SOURCE_INFO_QSS = "color: #555; font-style: italic; margin: 5px 0;"
+_CRS_INFO_QSS = "color: #666; font-size: 10px; margin-top: 10px;"
+_LINKS_LABEL_QSS = "margin-top: 5px;"
+_DOWNLOAD_BTN_QSS = """
+QPushButton {
+    background-color: #4CAF50;
+    color: white;
+    padding: 8px;
+    font-weight: bold;
+    border-radius: 4px;
+}
+QPushButton:hover {
+    background-color: #45a049;
+}
+"""
+
+# Współdzielony obiekt CRS EPSG:3857 (tworzony po starcie aplikacji Qt)
+_CRS_3857 = None
+
+
+def _tile_xy(mx, my, z):
+    """Zamienia współrzędne EPSG:3857 na numer kafelka (x, y) na poziomie z"""
+    n = 2 ** z
+    x = int((mx + _MERCATOR_HALF_SIZE) / (2 * _MERCATOR_HALF_SIZE) * n)
+    y = int((_MERCATOR_HALF_SIZE - my) / (2 * _MERCATOR_HALF_SIZE) * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _get_crs_3857():
+    """Zwraca współdzielony obiekt QgsCoordinateReferenceSystem dla EPSG:3857"""
+    global _CRS_3857
+    if _CRS_3857 is None:
+        _CRS_3857 = QgsCoordinateReferenceSystem("EPSG:3857")
+    return _CRS_3857
+
+
+def _allow_http2(request):
+    """Zezwala na HTTP/2 dla zapytań o kafelki (multipleksowanie w jednym połączeniu)"""
+    url = request.url()
+    if url.scheme() == "https" and url.host() in _TILE_HOSTS:
+        request.setAttribute(_HTTP2_ATTRIBUTE, True)
+
+
 class OlsztynGeoportalDialog(QDialog):
     """Dialog do wyboru warstw OpenStreetMap"""
     
@@ -25,12 +140,12 @@ class OlsztynGeoportalDialog(QDialog):
         
         # Informacja
         info_label = QLabel("Wybierz warstwę OpenStreetMap dla obszaru Olsztyna:")
-        info_label.setStyleSheet("font-weight: bold; margin-bottom: 10px;")
+        info_label.setStyleSheet(_INFO_LABEL_QSS)
         layout.addWidget(info_label)
         
         # Informacja o źródle - tylko OpenStreetMap
         source_info = QLabel("📍 Źródło danych: OpenStreetMap (wolne dane geograficzne)")
-        source_info.setStyleSheet("color: #555; font-style: italic; margin: 5px 0;")
+        source_info.setStyleSheet(_SOURCE_INFO_QSS)
         layout.addWidget(source_info)
         
         # Lista warstw
@@ -46,70 +161,26 @@ class OlsztynGeoportalDialog(QDialog):
         # Centrum Olsztyna: lon=20.48, lat=53.78
         # X = 2279852, Y = 7136945
         # Obszar: ~15km x 15km wokół centrum
-        self.olsztyn_bbox = "2272000,7129000,2288000,7145000"
-        
-        # Definicje warstw OpenStreetMap
-        self.layers = {
-            "Standardowa mapa OSM": {
-                "type": "xyz",
-                "url": "https://tile.openstreetmap.org/{z}/{x}/{y}.png",
-                "zmin": 0,
-                "zmax": 19,
-                "crs": "EPSG:3857",
-                "info": "Standardowa mapa OpenStreetMap z pełnymi detalami"
-            },
-            "OpenTopoMap (topograficzna)": {
-                "type": "xyz",
-                "url": "https://a.tile.opentopomap.org/{z}/{x}/{y}.png",
-                "zmin": 0,
-                "zmax": 17,
-                "crs": "EPSG:3857",
-                "info": "Mapa topograficzna ze szlakiami i warstwicami"
-            },
-            "CyclOSM (dla rowerzystów)": {
-                "type": "xyz",
-                "url": "https://a.tile-cyclosm.openstreetmap.fr/cyclosm/{z}/{x}/{y}.png",
-                "zmin": 0,
-                "zmax": 20,
-                "crs": "EPSG:3857",
-                "info": "Mapa z wyróżnionymi ścieżkami rowerowymi"
-            },
-            "Humanitarian (humanitarna)": {
-                "type": "xyz",
-                "url": "https://a.tile.openstreetmap.fr/hot/{z}/{x}/{y}.png",
-                "zmin": 0,
-                "zmax": 20,
-                "crs": "EPSG:3857",
-                "info": "Mapa humanitarna z wyróżnionymi budynkami"
-            },
-            "Transport": {
-                "type": "xyz",
-                "url": "https://tile.memomaps.de/tilegen/{z}/{x}/{y}.png",
-                "zmin": 0,
-                "zmax": 18,
-                "crs": "EPSG:3857",
-                "info": "Mapa komunikacji publicznej i transportu"
-            }
-        }
+        self.olsztyn_extent = QgsRectangle(2272000.0, 7129000.0, 2288000.0, 7145000.0)
+        self._crs_3857 = _get_crs_3857()
+        
+        # Kopia definicji warstw (uzupełniana o URI dostawcy)
+        self.layers = {name: dict(info) for name, info in _LAYERS.items()}
+        
+        # URI dostawcy XYZ (kafelki) budowane raz dla każdej warstwy
+        for layer_info in self.layers.values():
+            layer_info["uri"] = (
+                f"type=xyz&url={layer_info['url']}"
+                f"&zmin={layer_info['zmin']}&zmax={layer_info['zmax']}"
+                f"&crs={self._crs_3857.authid()}&referer={_REFERER}"
+            )
         
         # Wypełnij listę warstw
-        for layer_name in self.layers.keys():
-            self.layer_combo.addItem(layer_name)
+        self.layer_combo.addItems(list(self.layers))
         
         # Przycisk pobierania
         self.download_btn = QPushButton("Pobierz i dodaj warstwę do projektu")
-        self.download_btn.setStyleSheet("""
-            QPushButton {
-                background-color: #4CAF50;
-                color: white;
-                padding: 8px;
-                font-weight: bold;
-                border-radius: 4px;
-            }
-            QPushButton:hover {
-                background-color: #45a049;
-            }
-        """)
+        self.download_btn.setStyleSheet(_DOWNLOAD_BTN_QSS)
         self.download_btn.clicked.connect(self.download_layer)
         layout.addWidget(self.download_btn)
         
@@ -124,7 +195,7 @@ class OlsztynGeoportalDialog(QDialog):
             "ℹ️ Licencja: ODbL (Open Database License)\n"
             "ℹ️ © Współtwórcy OpenStreetMap"
         )
-        crs_info.setStyleSheet("color: #666; font-size: 10px; margin-top: 10px;")
+        crs_info.setStyleSheet(_CRS_INFO_QSS)
         layout.addWidget(crs_info)
         
         # Linki do geoportali
@@ -136,7 +207,7 @@ class OlsztynGeoportalDialog(QDialog):
             '</div>'
         )
         links_label.setOpenExternalLinks(True)
-        links_label.setStyleSheet("margin-top: 5px;")
+        links_label.setStyleSheet(_LINKS_LABEL_QSS)
         layout.addWidget(links_label)
         
         self.setLayout(layout)
@@ -155,31 +226,22 @@ class OlsztynGeoportalDialog(QDialog):
         
         try:
             if layer_info["type"] == "xyz":
-                # Budowanie URL dla warstwy XYZ (kafelki)
-                url_parts = [
-                    f"type=xyz",
-                    f"url={layer_info['url']}",
-                    f"zmin={layer_info['zmin']}",
-                    f"zmax={layer_info['zmax']}",
-                    f"crs={layer_info['crs']}"
-                ]
-                
-                url = "&".join(url_parts)
-                
                 # Tworzenie warstwy rastrowej XYZ
-                layer = QgsRasterLayer(url, selected_layer, "wms")
+                layer = QgsRasterLayer(layer_info["uri"], selected_layer, "wms")
                 
                 if layer.isValid():
-                    # Ustawienie CRS projektu na EPSG:3857 jeśli jest pusty
+                    # Ustawienie CRS projektu na EPSG:3857, jeśli jeszcze nie jest ustawiony
                     project = QgsProject.instance()
-                    if not project.crs().isValid() or project.crs().authid() == '':
-                        target_crs = QgsCoordinateReferenceSystem("EPSG:3857")
-                        project.setCrs(target_crs)
-                        QMessageBox.information(
-                            self,
-                            "Informacja",
-                            "Ustawiono CRS projektu na EPSG:3857 (Web Mercator)"
-                        )
+                    current_crs = project.crs()
+                    if not current_crs.isValid() or current_crs.authid() != self._crs_3857.authid():
+                        project.setCrs(self._crs_3857)
+                        # Informuj tylko, gdy projekt zawierał już warstwy
+                        if project.mapLayers():
+                            QMessageBox.information(
+                                self,
+                                "Informacja",
+                                "Ustawiono CRS projektu na EPSG:3857 (Web Mercator)"
+                            )
                     
                     # Dodanie warstwy do projektu
                     QgsProject.instance().addMapLayer(layer)
@@ -187,39 +249,30 @@ class OlsztynGeoportalDialog(QDialog):
                     # Informacja dodatkowa
                     info_text = ""
                     if "info" in layer_info:
-                        info_text = f"\n\nℹ️ {layer_info['info']}"
+                        info_text = f" – {layer_info['info']}"
                     
                     # Ustawienie widoku na Olsztyn
                     if self.iface:
                         canvas = self.iface.mapCanvas()
                         
-                        # Współrzędne Olsztyna w EPSG:3857 (Web Mercator)
-                        bbox_coords = self.olsztyn_bbox.split(',')
-                        if len(bbox_coords) == 4:
-                            extent = QgsRectangle(
-                                float(bbox_coords[0]), float(bbox_coords[1]),
-                                float(bbox_coords[2]), float(bbox_coords[3])
-                            )
-                            
-                            # Ustaw CRS canvas na EPSG:3857
-                            canvas.setDestinationCrs(QgsCoordinateReferenceSystem("EPSG:3857"))
-                            
-                            # Ustaw zasięg
-                            canvas.setExtent(extent)
-                            
-                            # Odśwież mapę
-                            canvas.refresh()
-                            
-                            # Dodatkowe wymuszenie centrum
-                            canvas.zoomToFeatureExtent(extent)
+                        # Ustaw CRS canvas na EPSG:3857
+                        canvas.setDestinationCrs(self._crs_3857)
+                        
+                        # Ustaw zasięg na Olsztyn i odśwież mapę (jedno renderowanie)
+                        canvas.setExtent(self.olsztyn_extent)
+                        canvas.refresh()
+                        
+                        # Kafelki sąsiadujące z widokiem pobierane po pierwszym renderowaniu
+                        self._schedule_prefetch(canvas, layer_info)
                     
-                    QMessageBox.information(
-                        self,
-                        "Sukces",
-                        f"Warstwa '{selected_layer}' została pomyślnie dodana do projektu.\n\n"
-                        f"CRS warstwy: {layer_info['crs']}{info_text}\n\n"
-                        f"Widok ustawiony na obszar Olsztyna."
-                    )
+                    # Nieblokujący komunikat na pasku wiadomości QGIS
+                    if self.iface:
+                        self.iface.messageBar().pushMessage(
+                            "Sukces",
+                            f"Warstwa '{selected_layer}' dodana (CRS: {layer_info['crs']}){info_text}",
+                            level=Qgis.Success,
+                            duration=5
+                        )
                     self.accept()
                 else:
                     error_msg = layer.error().message() if layer.error() else "Nieznany błąd"
@@ -244,6 +297,61 @@ class OlsztynGeoportalDialog(QDialog):
         
         finally:
             self.progress_bar.setVisible(False)
+    
+    def _schedule_prefetch(self, canvas, layer_info):
+        """Uruchamia jednorazowo pobieranie kafelków po zakończeniu renderowania mapy"""
+        def on_refreshed():
+            canvas.mapCanvasRefreshed.disconnect(on_refreshed)
+            try:
+                self._prefetch_tiles(layer_info, canvas.mapSettings())
+            except Exception:
+                # Pobieranie z wyprzedzeniem jest opcjonalne - błąd nie może
+                # wpłynąć na dodaną już warstwę
+                pass
+        
+        canvas.mapCanvasRefreshed.connect(on_refreshed)
+    
+    def _prefetch_tiles(self, layer_info, map_settings):
+        """Pobiera do cache QGIS pierścień kafelków otaczających widoczny obszar"""
+        # Zasięg dopasowany do proporcji okna i rozmiar w pikselach fizycznych
+        # (na ekranach HiDPI dostawca XYZ renderuje z devicePixelRatio)
+        extent = map_settings.visibleExtent()
+        pixel_ratio = getattr(map_settings, "devicePixelRatio", lambda: 1.0)()
+        width_px = map_settings.outputSize().width() * pixel_ratio
+        if extent.width() <= 0 or width_px <= 0:
+            return
+        
+        resolution = extent.width() / width_px
+        z = round(math.log2(2 * _MERCATOR_HALF_SIZE / (256 * resolution)))
+        z = min(max(z, layer_info['zmin']), layer_info['zmax'])
+        
+        x0, y0 = _tile_xy(extent.xMinimum(), extent.yMaximum(), z)
+        x1, y1 = _tile_xy(extent.xMaximum(), extent.yMinimum(), z)
+        n = 2 ** z
+        
+        # Kafelki widoczne pobiera renderer, więc tutaj tylko pierścień wokół
+        # nich, w kolejności obchodzenia obwodu (góra, prawo, dół, lewo)
+        ring = (
+            [(x, y0 - 1) for x in range(x0 - 1, x1 + 2)]
+            + [(x1 + 1, y) for y in range(y0, y1 + 1)]
+            + [(x, y1 + 1) for x in range(x1 + 1, x0 - 2, -1)]
+            + [(x0 - 1, y) for y in range(y1, y0 - 1, -1)]
+        )
+        tiles = [(x, y) for x, y in ring if 0 <= x < n and 0 <= y < n]
+        
+        # Przy przekroczeniu limitu wybierz kafelki równomiernie z całego obwodu
+        if len(tiles) > _MAX_PREFETCH_TILES:
+            step = len(tiles) / _MAX_PREFETCH_TILES
+            tiles = [tiles[int(i * step)] for i in range(_MAX_PREFETCH_TILES)]
+        
+        manager = QgsNetworkAccessManager.instance()
+        for x, y in tiles:
+            request = QNetworkRequest(QUrl(layer_info['url'].format(z=z, x=x, y=y)))
+            request.setRawHeader(b"Referer", _REFERER.encode())
+            request.setAttribute(QNetworkRequest.CacheLoadControlAttribute,
+                                 QNetworkRequest.PreferCache)
+            reply = manager.get(request)
+            reply.finished.connect(reply.deleteLater)
 
 
 class OlsztynGeoportal:
@@ -256,6 +364,47 @@ class OlsztynGeoportal:
         self.menu = 'Geoportal Olsztyn'
         self.toolbar = self.iface.addToolBar('Geoportal Olsztyn')
         self.toolbar.setObjectName('GeoportalOlsztyn')
+        self.preprocessor_id = None
+        self._dialog = None
+        self.previous_cache_size = None
+        _get_crs_3857()
+        self.ensure_cache_size()
+    
+    def ensure_cache_size(self):
+        """Zwiększa dyskowy cache sieciowy QGIS ustawiony jawnie poniżej _MIN_CACHE_SIZE"""
+        settings = QSettings()
+        key = next((k for k in _CACHE_SIZE_KEYS if settings.contains(k)), None)
+        if key is None:
+            return
+        
+        try:
+            current_size = int(settings.value(key))
+        except (TypeError, ValueError):
+            return
+        
+        # 0 oznacza rozmiar automatyczny QGIS - nie nadpisuj go
+        if current_size <= 0 or current_size >= _MIN_CACHE_SIZE:
+            return
+        
+        settings.setValue(key, _MIN_CACHE_SIZE)
+        self.previous_cache_size = (key, current_size)
+        self._set_cache_size(_MIN_CACHE_SIZE)
+    
+    def restore_cache_size(self):
+        """Przywraca rozmiar cache sprzed uruchomienia wtyczki"""
+        if self.previous_cache_size is None:
+            return
+        
+        key, size = self.previous_cache_size
+        QSettings().setValue(key, size)
+        self._set_cache_size(size)
+        self.previous_cache_size = None
+    
+    def _set_cache_size(self, size):
+        """Ustawia maksymalny rozmiar aktywnego cache sieciowego QGIS"""
+        cache = QgsNetworkAccessManager.instance().cache()
+        if cache is not None and hasattr(cache, "setMaximumCacheSize"):
+            cache.setMaximumCacheSize(size)
     
     def add_action(
         self,
@@ -304,6 +453,11 @@ class OlsztynGeoportal:
             callback=self.run,
             parent=self.iface.mainWindow()
         )
+        
+        # HTTP/2 dla pobierania kafelków (QGIS >= 3.22, Qt z obsługą HTTP/2)
+        if (_HTTP2_ATTRIBUTE is not None
+                and hasattr(QgsNetworkAccessManager, "setRequestPreprocessor")):
+            self.preprocessor_id = QgsNetworkAccessManager.setRequestPreprocessor(_allow_http2)
     
     def unload(self):
         """Usuwa wtyczkę i czyści GUI"""
@@ -313,12 +467,23 @@ class OlsztynGeoportal:
                 action
             )
             self.iface.removeToolBarIcon(action)
+        if self.preprocessor_id is not None:
+            QgsNetworkAccessManager.removeRequestPreprocessor(self.preprocessor_id)
+            self.preprocessor_id = None
+        self.restore_cache_size()
+        if self._dialog is not None:
+            self._dialog.deleteLater()
+            self._dialog = None
         del self.toolbar
     
     def run(self):
         """Uruchamia wtyczkę"""
-        dialog = OlsztynGeoportalDialog(self.iface)
-        dialog.exec_()
+        # Dialog tworzony raz i używany ponownie przy kolejnych uruchomieniach
+        if self._dialog is None:
+            self._dialog = OlsztynGeoportalDialog(self.iface, self.iface.mainWindow())
+        self._dialog.show()
+        self._dialog.raise_()
+        self._dialog.activateWindow()
 
 
 def classFactory(iface):